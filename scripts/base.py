@@ -19,7 +19,7 @@ def _stat_fun(x, sigma=0, method='relative'):
     return t_values
 
 
-def stats(X, connectivity=None, n_jobs=-1):
+def stats(X, connectivity=None, n_jobs=-1, n_permutations=2**12, seed=None):
     """Cluster statistics to control for multiple comparisons.
 
     Parameters
@@ -31,12 +31,16 @@ def stats(X, connectivity=None, n_jobs=-1):
         neighboring cells of X.
     n_jobs : int
         The number of parallel processors.
+    n_permutations : int
+        The number of permutations.
+    seed : None | int
+        The seed of the random permutations.
     """
     X = np.array(X)
     X = X[:, :, None] if X.ndim == 2 else X
     T_obs_, clusters, p_values, _ = spatio_temporal_cluster_1samp_test(
-        X, out_type='mask', stat_fun=_stat_fun, n_permutations=2**12,
-        n_jobs=n_jobs, connectivity=connectivity)
+        X, out_type='mask', stat_fun=_stat_fun, n_permutations=n_permutations,
+        n_jobs=n_jobs, connectivity=connectivity, seed=seed)
     p_values_ = np.ones_like(X[0]).T
     for cluster, pval in zip(clusters, p_values):
         p_values_[cluster.T] = pval
@@ -61,6 +61,8 @@ def paths(typ, subject='fsaverage', analysis='analysis', block=999):
         epochs=op.join(this_path, '%s-epo.fif' % subject),
         epochs_decim=op.join(this_path, '%s_decim-epo.fif' % subject),
         epochs_vhp=op.join(this_path, '%s_vhp-epo.fif' % subject),
+        epochs_prepared=op.join(this_path,
+                                '%s_%s-epo.fif' % (subject, analysis)),
         trans=op.join(this_path, '%s-trans.fif' % subject),
         fwd=op.join(this_path, '%s-fwd.fif' % subject),
         cov=op.join(this_path, '%s-cov.fif' % subject),
@@ -74,6 +76,10 @@ def paths(typ, subject='fsaverage', analysis='analysis', block=999):
         score=op.join(this_path, '%s_%s_scores.pickle' % (subject, analysis)),
         score_tfr=op.join(this_path,
                           '%s_%s_tfr_scores.pickle' % (subject, analysis)),
+        score_tfr_array=op.join(this_path,
+                                '%s_%s_tfr_scores.npy' % (subject, analysis)),
+        score_array=op.join(this_path,
+                            '%s_%s_scores.npy' % (subject, analysis)),
         score_source=op.join(
             this_path, '%s_%s_scores.npy' % (subject, analysis)),
         score_pval=op.join(
@@ -106,7 +112,8 @@ def load(typ, subject='fsaverage', analysis='analysis', block=999,
         out = read_events(fname)
     elif typ == 'sss':
         out = Raw(fname, preload=preload)
-    elif typ in ['epo_block', 'epochs', 'epochs_decim', 'epochs_vhp']:
+    elif typ in ['epo_block', 'epochs', 'epochs_decim', 'epochs_vhp',
+                 'epochs_prepared']:
         out = read_epochs(fname, preload=preload)
     elif typ in ['cov']:
         from mne.cov import read_cov
@@ -128,6 +135,8 @@ def load(typ, subject='fsaverage', analysis='analysis', block=999,
                          shape=loader['shape'])
     elif typ in ['score_source', 'score_pval']:
         out = np.load(fname)
+    elif typ in ['score_tfr_array', 'score_array']:
+        out = np.load(fname, mmap_mode='r')
     else:
         raise NotImplementedError()
     return out
@@ -145,12 +154,14 @@ def save(var, typ, subject='fsaverage', analysis='analysis', block=999,
         return False
 
     # different data format depending file type
-    if typ in ['epo_block', 'epochs', 'epochs_decim', 'cov', 'epochs_vhp']:
+    if typ in ['epo_block', 'epochs', 'epochs_decim', 'cov', 'epochs_vhp',
+               'epochs_prepared']:
         var.save(fname)
     elif typ in ['evoked', 'decod', 'decod_tfr', 'score', 'score_tfr',
                  'evoked_source']:
         with open(fname, 'wb') as f:
-            pickle.dump(var, f)
+            # binary protocol: much smaller and faster for numpy arrays
+            pickle.dump(var, f, pickle.HIGHEST_PROTOCOL)
     elif typ in ['inv']:
         from mne.minimum_norm import write_inverse_operator
         write_inverse_operator(fname, var)
@@ -160,7 +171,8 @@ def save(var, typ, subject='fsaverage', analysis='analysis', block=999,
     elif typ == 'morph':
         np.savez(fname, data=var.data, indices=var.indices,
                  indptr=var.indptr, shape=var.shape)
-    elif typ in ['score_source', 'score_pval']:
+    elif typ in ['score_source', 'score_pval', 'score_tfr_array',
+                 'score_array']:
         np.save(fname, var)
     else:
         raise NotImplementedError()
@@ -6,6 +6,8 @@
 
 Used to generate Figure 3.
 """
+import os.path as op
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
@@ -13,42 +15,83 @@ import matplotlib.gridspec as gridspec
 from jr.plot import pretty_plot, pretty_colorbar
 from base import stats
 from conditions import analyses
-from config import load, subjects, report
+from config import load, subjects, report, paths
+
+
+def _load_scores(analysis, n_jobs=8):
+    """Load the time-frequency scores of each subject. The files are read
+    concurrently, as this is I/O bound."""
+    name = analysis['name']
+
+    def _array_is_current(subject):
+        # the float32 scores are only used if they are at least as recent as
+        # the pickled ones, which they duplicate
+        fname = paths('score_tfr_array', subject=subject, analysis=name)
+        fname_pickle = paths('score_tfr', subject=subject, analysis=name)
+        return op.exists(fname) and (
+            not op.exists(fname_pickle) or
+            op.getmtime(fname) >= op.getmtime(fname_pickle))
+
+    # read all subjects from the same source, so that they are consistent
+    use_array = all(_array_is_current(subject) for subject in subjects)
+
+    def _load(subject):
+        if use_array:
+            return load('score_tfr_array', subject=subject, analysis=name)
+        return load('score_tfr', subject=subject, analysis=name)[0]
+
+    # times and frequencies are shared across subjects. They are only stored
+    # in the pickles: with the float32 scores, this is the single pickle read.
+    score, times, freqs = load('score_tfr', subject=subjects[0],
+                               analysis=name)
+    # the memory-mapped scores are copied straight into a single float32 array
+    scores = np.empty((len(subjects),) + np.shape(score), dtype=np.float32)
+    todo = range(len(subjects))
+    if not use_array:
+        # the first subject has already been read
+        scores[0] = score
+        todo = todo[1:]
+    del score
+
+    def _fill(s):
+        scores[s] = _load(subjects[s])
+    pool = ThreadPool(n_jobs)
+    try:
+        pool.map(_fill, todo)
+    finally:
+        pool.close()
+        pool.join()
+    return scores, times, freqs
+
 
 fig = plt.figure(figsize=[18, 5])
 axes = gridspec.GridSpec(2, 5, left=0.05, right=.95, hspace=0.35, wspace=.25)
 for ii, (analysis, ax) in enumerate(zip(analyses, axes)):
     ax = fig.add_subplot(ax)
-    scores = list()
-    for subject in subjects:
-        score, times, freqs = load('score_tfr', subject=subject,
-                                   analysis=analysis['name'])
-        scores.append(score)
-    scores = np.array(scores)
+    scores, times, freqs = _load_scores(analysis)
     if 'circAngle' in analysis['name']:
         scores /= 2
-    # compute stats
-    p_val = stats(scores - analysis['chance'])
+    # compute stats: remove chance in place to avoid copying all subjects
+    scores -= analysis['chance']
+    p_val = stats(scores)
     sig = p_val < .05
 
     # plot effect size
-    scores = np.mean(scores, axis=0)
+    scores = np.mean(scores, axis=0) + analysis['chance']
     im = ax.matshow(scores, aspect='auto', origin='lower',
                     extent=[times[0], times[-1], 0, len(freqs)],
                     vmin=analysis['chance'], vmax=np.max(scores),
                     cmap=analysis['cmap'])
 
     # plot stats
-    xx, yy = np.meshgrid(times, range(len(freqs)), copy=False, indexing='xy')
-    ax.contour(xx, yy, sig, colors='black', levels=[0],
+    ax.contour(times, np.arange(len(freqs)), sig, colors='black', levels=[0],
                linestyles='dotted')
 
     # pretty plot
     pretty_plot(ax)
-    ticks = [0]
-    for freq in np.arange(10, 71, 10):
-        ticks.append(np.where(np.round(freqs) >= freq)[0][0])
-    ticks.append(len(freqs))
+    # first frequency above each tick (freqs are sorted)
+    ticks = np.searchsorted(np.round(freqs), np.arange(10, 71, 10))
+    ticks = np.r_[0, ticks, len(freqs)]
     ax.set_yticks(ticks)
     ax.set_yticklabels([])
     if ii in [0, (len(analyses)//2)]:
@@ -5,55 +5,127 @@
 """Run decoding and temporal generalization analyses for each subject
 separately.
 """
+import hashlib
+import os
+import os.path as op
 import numpy as np
+import mne
 from mne.decoding import GeneralizationAcrossTime
-from config import subjects, load, save
+from mne.parallel import parallel_func
+from config import subjects, load, save, paths
 from conditions import analyses
 
+# only analyze MEG from -100 ms to 1400 ms after target onset
+pick_params = dict(meg=True, eeg=False, stim=False, eog=False, ecg=False)
+crop_params = dict(tmin=-.1, tmax=1.4)
+
+# Number of subjects processed in parallel. As each subject holds its epochs in
+# memory, this defaults to 1. When subjects run in parallel, each GAT is fitted
+# on a single core to avoid oversubscribing the machine.
+n_jobs_subjects = int(os.environ.get('n_jobs_subjects', 1))
+n_jobs_gat = -1 if n_jobs_subjects == 1 else 1
+
+# Analyses already computed with the current version of the decoding code are
+# skipped, unless the 'force' environment variable is set to True.
+force = os.environ.get('force') == 'True'
+# The tag covers this script, the analyses and paths it imports, and the
+# vendored jr-tools that define the estimators and scorers.
+code_tag = ''
+scripts_path = op.dirname(op.abspath(__file__))
+for fname in ['run_decoding.py', 'conditions.py', 'config.py',
+              op.join('..', 'externals', 'jr-tools.zip')]:
+    with open(op.join(scripts_path, fname), 'rb') as f:
+        code_tag += f.read()
+code_tag = hashlib.sha1(code_tag).hexdigest()[:8]
+
+
+def _done_fname(subject, analysis):
+    """Empty file marking an analysis computed with the current code"""
+    fname = paths('score', subject=subject, analysis=analysis['name'])
+    return fname + '.%s.ok' % code_tag
+
+
+def _load_prepared_epochs(subject):
+    """Load the picked and cropped epochs of a given subject. The result is
+    cached on disk, and keyed by the preprocessing parameters, so that reruns
+    skip the reading, picking and cropping of the full epochs. The cache is
+    only used if it is at least as recent as the source epochs."""
+    key = repr((sorted(pick_params.items()), sorted(crop_params.items()),
+                mne.__version__))
+    key = 'prepared_' + hashlib.sha1(key).hexdigest()[:8]
+    fname = paths('epochs_prepared', subject=subject, analysis=key)
+    fname_source = paths('epochs_decim', subject=subject)
+    if op.exists(fname) and (
+            not op.exists(fname_source) or
+            op.getmtime(fname) >= op.getmtime(fname_source)):
+        epochs = load('epochs_prepared', subject=subject, analysis=key,
+                      preload=True)
+    else:
+        epochs = load('epochs_decim', subject=subject, preload=True)
+        epochs.pick_types(**pick_params)
+        epochs.crop(**crop_params)
+        save(epochs, 'epochs_prepared', subject=subject, analysis=key,
+             overwrite=True, upload=False)
+    # fif files store single precision data: keeping it as float32 halves the
+    # memory used by the epochs and by each selection of trials. This only
+    # concerns the data held in memory: the saved scores and predictions are
+    # float64, as they are computed with the estimators' float64 coefficients.
+    epochs._data = epochs._data.astype(np.float32, copy=False)
+    return epochs
+
+
+def _strip_gat(gat, analysis):
+    """Remove the fitted attributes that are not needed by the subsequent
+    analyses to save space. y_train_ and _cv_splits are kept as they are
+    needed to subscore the predictions."""
+    if analysis['name'] not in ['probe_phase', 'target_circAngle']:
+        # we'll need the estimator trained on the probe_phase and to generalize
+        # to the target phase and prove that there is a significant signal.
+        gat.estimators_ = None
+    if analysis['name'] not in ['target_present', 'target_circAngle',
+                                'probe_circAngle']:
+        # We need these individual prediction to control for the correlation
+        # between target and probe angle.
+        gat.y_pred_ = None
+    return gat
 
-def _run(epochs, events, analysis):
+
+def _run(subject, epochs, events, query_sel, analysis):
     """Runs temporal generalization for a given subject and analysis"""
     print(subject, analysis['name'])
 
-    # subselect the trials (e.g. exclude absent trials) with a
-    # dataframe query defined in conditions.py
-    query, condition = analysis['query'], analysis['condition']
-    sel = range(len(events)) if query is None \
-        else events.query(query).index
-    sel = [ii for ii in sel if ~np.isnan(events[condition][sel][ii])]
-
     # The to-be-predicted value, for each trial:
+    query, condition = analysis['query'], analysis['condition']
     y = np.array(events[condition], dtype=np.float32)
 
+    # subselect the trials (e.g. exclude absent trials) with a
+    # dataframe query defined in conditions.py, and skip undefined values
+    sel = np.where(~np.isnan(y))[0]
+    if query is not None:
+        sel = np.intersect1d(query_sel[query], sel)
+
     print analysis['name'], np.unique(y[sel]), len(sel)
 
     # Abort if there is no trial
     if len(sel) == 0:
         return
 
+    # Select the trials once, as each selection copies the data
+    epochs_sel, y_sel = epochs[sel], y[sel]
+
     # Apply analysis
     gat = GeneralizationAcrossTime(clf=analysis['clf'],
                                    cv=analysis['cv'],
                                    scorer=analysis['scorer'],
-                                   n_jobs=-1)
+                                   n_jobs=n_jobs_gat)
     print(subject, analysis['name'], 'fit')
-    gat.fit(epochs[sel], y=y[sel])
+    gat.fit(epochs_sel, y=y_sel)
     print(subject, analysis['name'], 'score')
-    score = gat.score(epochs[sel], y=y[sel])
+    score = gat.score(epochs_sel, y=y_sel)
     print(subject, analysis['name'], 'save')
 
-    # save space
-    if analysis['name'] not in ['probe_phase', 'target_circAngle']:
-        # we'll need the estimator trained on the probe_phase and to generalize
-        # to the target phase and prove that there is a significant signal.
-        gat.estimators_ = None
-    if analysis['name'] not in ['target_present', 'target_circAngle',
-                                'probe_circAngle']:
-        # We need these individual prediction to control for the correlation
-        # between target and probe angle.
-        gat.y_pred_ = None
-
     # Save analysis
+    gat = _strip_gat(gat, analysis)
     save([gat, analysis, sel, events], 'decod',
          subject=subject, analysis=analysis['name'], overwrite=True,
          upload=True)
@@ -63,20 +135,35 @@ def _run(epochs, events, analysis):
     return
 
 
-for s, subject in enumerate(subjects):  # Loop across each subject
+def _run_subject(subject):
+    """Runs all analyses of a given subject"""
     print(subject)
 
-    # load data
-    epochs = load('epochs_decim', subject=subject, preload=True)
+    # don't recompute if not necessary
+    todo = [analysis for analysis in analyses
+            if force or not op.exists(_done_fname(subject, analysis))]
+    if not len(todo):
+        return
 
-    # only analyze MEG from -100 ms to 1400 ms after target onset
-    epochs.pick_types(meg=True, eeg=False, stim=False, eog=False, ecg=False)
-    epochs.crop(-.1, 1.4)
+    # load data
+    epochs = _load_prepared_epochs(subject)
     events = load('behavior', subject=subject)
 
+    # Evaluate each dataframe query once, as several analyses share them
+    query_sel = dict()
+    for query in set(analysis['query'] for analysis in todo):
+        if query is not None:
+            query_sel[query] = events.query(query).index
+
     # Apply to each analysis (e.g. presence, orientation, ...)
-    for analysis in analyses:
-        _run(epochs, events, analysis)
+    for analysis in todo:
+        _run(subject, epochs, events, query_sel, analysis)
+        open(_done_fname(subject, analysis), 'w').close()
 
     # Clear memory
     del epochs, events
+
+
+# Loop across each subject
+parallel, p_run_subject, _ = parallel_func(_run_subject, n_jobs_subjects)
+parallel(p_run_subject(subject) for subject in subjects)
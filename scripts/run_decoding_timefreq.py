@@ -24,10 +24,10 @@ def _run(epochs, events, analysis):
 
     # Select relevant trials (e.g. remove absent trials)
     query, condition = analysis['query'], analysis['condition']
-    sel = range(len(events)) if query is None \
-        else events.query(query).index
-    sel = [ii for ii in sel if ~np.isnan(events[condition][sel][ii])]
     y = np.array(events[condition], dtype=np.float32)
+    sel = np.where(~np.isnan(y))[0]
+    if query is not None:
+        sel = np.intersect1d(events.query(query).index, sel)
 
     print analysis['name'], np.unique(y[sel]), len(sel)
 
@@ -56,6 +56,9 @@ def _run(epochs, events, analysis):
              subject=subject, analysis=analysis['name'], overwrite=True)
     save([score, epochs.times[decim], frequencies], 'score_tfr',
          subject=subject, analysis=analysis['name'], overwrite=True)
+    # also save the scores alone, so that they can be memory mapped
+    save(np.array(score, dtype=np.float32), 'score_tfr_array',
+         subject=subject, analysis=analysis['name'], overwrite=True)
 
 for s, subject in enumerate(subjects):  # Loop across each subject
     print(subject)
@@ -75,8 +75,7 @@ def simulate_model(sources, mixin, background, snr=.5, n_trial=100):
     visibility = np.concatenate(visibility, axis=0)
 
     # shuffle trials
-    idx = range(n_trial * 2)
-    np.random.shuffle(idx)
+    idx = np.random.permutation(n_trial * 2)
     X, y, visibility = X[idx], y[idx], visibility[idx]
 
     # format to MNE epochs
@@ -9,14 +9,23 @@ experimental condition).
 Used to generate Figure 6.
 """
 import os
+import os.path as op
+import hashlib
 import numpy as np
-from scipy.stats import wilcoxon
+from scipy.stats import wilcoxon, rankdata
+try:
+    # optional: bottleneck's nan-aware reductions are faster than numpy's
+    from bottleneck import nanmean, nanstd
+except ImportError:
+    from numpy import nanmean, nanstd
 import matplotlib.pyplot as plt
+import mne
+from mne.parallel import parallel_func
 from jr.gat import subscore, get_diagonal_ypred
 from jr.stats import repeated_spearman
 from jr.plot import (pretty_plot, pretty_gat, share_clim, pretty_axes,
                      pretty_decod, plot_sem, bar_sem)
-from jr.utils import align_on_diag, table2html
+from jr.utils import table2html
 from config import subjects, load, save, paths, report
 from base import stats
 from conditions import analyses, tois
@@ -25,6 +34,154 @@ from conditions import analyses, tois
 analyses = [analysis for analysis in analyses if analysis['name'] in
             ['target_present', 'target_circAngle']]
 
+# Number of subjects processed in parallel. As each subject holds its GAT
+# predictions in memory, this defaults to 1.
+n_jobs_subjects = int(os.environ.get('n_jobs_subjects', 1))
+
+# Cluster statistics parameters. The permutations are seeded so that cached
+# p-values are those a recomputation would give. The cache is tagged with these
+# parameters and with the statistics code, i.e. base.py and MNE.
+stats_params = dict(connectivity=None, n_permutations=2 ** 12, seed=0)
+with open(op.join(op.dirname(op.abspath(__file__)), 'base.py'), 'rb') as f:
+    stats_tag = f.read()
+stats_tag += repr(sorted(stats_params.items())) + mne.__version__
+stats_tag = hashlib.sha1(stats_tag).hexdigest()[:8]
+
+
+def _cached_stats(X):
+    """Cluster statistics, cached on disk according to the content of X, as
+    the permutations are the most expensive step of these analyses"""
+    X = np.array(X, dtype=float)
+    key = hashlib.sha1(X.tostring() + str(X.shape)).hexdigest()
+    name = 'stats_%s_%s' % (stats_tag, key)
+    if os.path.exists(paths('score_pval', analysis=name)):
+        return load('score_pval', analysis=name)
+    p_values = stats(X, **stats_params)
+    save(p_values, 'score_pval', analysis=name, overwrite=True, upload=False)
+    return p_values
+
+
+def _subscore_subject(gat, events, analysis):
+    """Subscore the GAT of a subject for each reported visibility"""
+    detect = np.array(events['detect_button'])
+    absent = np.where(~np.array(events['target_present'], dtype=bool))[0]
+    vis_sels = [np.where(detect == vis)[0] for vis in range(4)]
+    scores = np.nan * np.empty((4,) + gat.y_pred_.shape[:2])
+    gat.score_mode = 'mean-sample-wise'
+    for vis, sel in enumerate(vis_sels):
+        # If target present, we use the AUC against all absent trials
+        if len(sel) < 5:
+            continue
+        if analysis['name'] == 'target_present':
+            sel = np.concatenate((sel, absent))
+        scores[vis] = subscore(gat, sel)
+    return scores
+
+
+def _continuous_subject(gat, events, analysis):
+    """Subscore and regress the diagonal predictions of a subject as a
+    function of visibility and contrast"""
+    y_pred = np.transpose(get_diagonal_ypred(gat), [1, 0, 2])[..., 0]
+    y_true = events[analysis['name']]
+    scores, R = dict(), dict()
+    for factor in ['visibility', 'contrast']:
+        # subscore per condition (e.g. each visibility rating)
+        sels = _subscore_sels(events, analysis, factor)
+        scores[factor] = _subscore(y_pred, y_true, analysis, sels)
+        # correlate residuals with factor
+        R[factor] = _subregress(y_pred, events, analysis, factor, True)
+    return scores, R
+
+
+def _toi_subject(gat, events, analysis):
+    """Subscore and regress the predictions of a subject averaged within each
+    toi as a function of visibility and contrast"""
+    times = gat.train_times_['times']
+    toi_slices = [_toi_slice(times, toi) for toi in tois]
+    scores = dict(visibility=np.zeros((len(tois), 4)),
+                  contrast=np.zeros((len(tois), 3)))
+    R = dict(visibility=np.zeros(len(tois)),
+             contrast=np.zeros(len(tois)))
+    y_diag = np.asarray(get_diagonal_ypred(gat))
+    y_true = events[analysis['name']]
+    # the trials of each condition are the same for all tois
+    sels = dict((factor, _subscore_sels(events, analysis, factor))
+                for factor in ['visibility', 'contrast'])
+    for t, toi in enumerate(toi_slices):
+        # Average predictions on single trials across time points
+        y_pred = _average_ypred_toi(y_diag, toi, analysis)
+        for factor in ['visibility', 'contrast']:
+            # subscore per condition (e.g. each visibility rating)
+            scores[factor][t, :] = _subscore(y_pred, y_true, analysis,
+                                             sels[factor])
+            # correlate residuals with factor
+            R[factor][t] = _subregress(y_pred, events, analysis, factor, True)
+    return scores, R
+
+
+def _correlate_subject(gat, events, analysis):
+    """Correlate the predictions of a subject with the visibility reports"""
+    y_vis = np.array(events['detect_button'])
+
+    # only analyse present trials
+    sel = np.where(np.array(events['target_present'], dtype=bool))[0]
+    y_vis = y_vis[sel]
+
+    # rank the trials of all train and test times with a single sort, along
+    # the last axis: no transposition nor reshaping of the predictions. Ties
+    # get their average rank, as in repeated_spearman.
+    n_trials = len(sel)
+    ranks = _rankdata(gat.y_pred_[:, :, sel, 0], axis=2) - (n_trials + 1) / 2.
+    # regress: Pearson correlation of the centered ranks
+    y = rankdata(y_vis) - (n_trials + 1) / 2.
+    norm = np.sqrt(np.einsum('ijk,ijk->ij', ranks, ranks) * np.sum(y ** 2))
+    return np.einsum('ijk,k->ij', ranks, y) / norm
+
+
+# Per subject computations of each pipeline, named after their saved results.
+# The continuous results are suffixed as they are scored at each time point,
+# and the toi ones with the averaging method of the circular predictions, so
+# that the results saved with the former methods are not reused.
+subject_pipelines = {'-vis': _subscore_subject,
+                     '-continuous-timewise': _continuous_subject,
+                     '-toi-vecmean': _toi_subject,
+                     '-Rvis': _correlate_subject}
+gathered = dict()
+
+
+def _gather_subject(subject, analysis, todo):
+    """Load a subject once, and apply the per subject computations of the
+    given pipelines"""
+    gat, _, events_sel, events = load('decod', subject=subject,
+                                      analysis=analysis['name'])
+    # remove irrelevant trials once, and only keep the columns used by the
+    # pipelines as arrays
+    keys = ['detect_button', 'target_present', 'target_contrast',
+            analysis['name']]
+    events = dict((key, np.array(events[key])[events_sel]) for key in keys)
+    results = dict()
+    for suffix in todo:
+        results[suffix] = subject_pipelines[suffix](gat, events, analysis)
+    return results, gat.train_times_['times']
+
+
+def _gather(analysis):
+    """Apply the per subject computations of all pipelines whose results are
+    not saved yet, processing subjects in parallel"""
+    if analysis['name'] not in gathered:
+        todo = [suffix for suffix in subject_pipelines
+                if not os.path.exists(paths(
+                    'score', analysis=analysis['name'] + suffix))]
+        parallel, p_gather, _ = parallel_func(_gather_subject, n_jobs_subjects)
+        out = parallel(p_gather(subject, analysis, todo)
+                       for subject in subjects)
+        results = dict((suffix, [subject_results[suffix]
+                                 for subject_results, _ in out])
+                       for suffix in todo)
+        results['times'] = out[0][1]
+        gathered[analysis['name']] = results
+    return gathered[analysis['name']]
+
 
 def _subscore_pipeline(analysis):  # FIXME merge with subscore
     """Subscore each analysis as a function of the reported visibility"""
@@ -36,93 +193,177 @@ def _subscore_pipeline(analysis):  # FIXME merge with subscore
         return load('score', analysis=ana_name)
 
     # gather data
-    all_scores = list()
-    for subject in subjects:
-        gat, _, events_sel, events = load('decod', subject=subject,
-                                          analysis=analysis['name'])
-        times = gat.train_times_['times']
-        # remove irrelevant trials
-        events = events.iloc[events_sel].reset_index()
-        scores = list()
-        gat.score_mode = 'mean-sample-wise'
-        for vis in range(4):
-            sel = np.where(events['detect_button'] == vis)[0]
-            # If target present, we use the AUC against all absent trials
-            if len(sel) < 5:
-                scores.append(np.nan * np.empty(gat.y_pred_.shape[:2]))
-                continue
-            if analysis['name'] == 'target_present':
-                sel = np.r_[sel,
-                            np.where(events['target_present'] == False)[0]]  # noqa
-            score = subscore(gat, sel)
-            scores.append(score)
-        all_scores.append(scores)
-    all_scores = np.array(all_scores)
+    results = _gather(analysis)
+    all_scores = np.array(results.pop('-vis'))
+    times = results['times']
 
     # stats
     pval = list()
     for vis in range(4):
-        pval.append(stats(all_scores[:, vis, :, :] - analysis['chance']))
+        pval.append(_cached_stats(all_scores[:, vis, :, :] -
+                                  analysis['chance']))
 
     save([all_scores, pval, times],
          'score', analysis=ana_name, overwrite=True, upload=True)
+    # also store the scores alone so that they can be memory-mapped
+    save(all_scores, 'score_array', analysis=ana_name, overwrite=True,
+         upload=True)
     return all_scores, pval, times
 
 
-def _average_ypred_toi(gat, toi, analysis):
-    """Average single trial predictions of each time point in a given TOI"""
-    y_pred = np.transpose(get_diagonal_ypred(gat), [1, 0, 2])
-    times = gat.train_times_['times']
-    # select time sample
-    toi = np.where((times >= toi[0]) & (times <= toi[1]))[0]
+def _toi_slice(times, toi):
+    """Time samples within a toi. As times are sorted, this is a slice."""
+    return slice(np.searchsorted(times, toi[0], 'left'),
+                 np.searchsorted(times, toi[1], 'right'))
+
+
+def _average_ypred_toi(y_diag, toi, analysis):
+    """Average single trial predictions of each time point in a given TOI
+    slice
+    y_diag : shape(n_times, n_trials, n_dims), the diagonal predictions
+    """
     if 'circAngle' in analysis['name']:
-        # weight average by regressor radius
-        cos = np.cos(y_pred[:, toi, 0])
-        sin = np.sin(y_pred[:, toi, 0])
-        radius = y_pred[:, toi, 1]
-        y_pred = np.angle(np.median((cos + 1j * sin) * radius, axis=1))
+        # weight average by regressor radius: angle of the sum of the
+        # predicted vectors
+        radius = y_diag[toi, :, 1]
+        y_pred = np.angle(np.sum(radius * np.exp(1j * y_diag[toi, :, 0]),
+                                 axis=0))
     else:
-        y_pred = np.median(y_pred[:, toi], axis=1)
-    return np.squeeze(y_pred)
+        y_pred = np.median(y_diag[toi, :, 0], axis=0)
+    return y_pred
 
 
-def _subscore(y_pred, events, analysis, factor):
-    """Subscore each visibility
-    y_pred : shape(n_trials,)
-    events : dataframe, shape(n_trials,)
+def _subscore_sels(events, analysis, factor):
+    """Trials to subscore for each value of a factor
+    events : dict of arrays, shape(n_trials,)
     analysis : dict(name='target_present' | 'target_circAngle', scorer)
     key: 'detect_button' | 'target_contrast'
     values: range(4) | [.50, .75, 1.]
+    Returns a list of trial indices per value, None if it cannot be scored.
     """
-    scorer = analysis['scorer']
     factors = dict(visibility=['detect_button', range(4)],
                    contrast=['target_contrast', [.50, .75, 1.]])
     key, values = factors[factor]
-    y_true = events[analysis['name']]
-    if y_pred.ndim == 1:
-        y_pred = y_pred[:, np.newaxis]
-    n_samples, n_times = y_pred.shape
-
-    scores = np.nan * np.zeros((n_times, len(values)))
+    y_true = np.array(events[analysis['name']])
+    key_values = np.array(events[key])
+    absent = np.where(~np.array(events['target_present'], dtype=bool))[0]
 
-    for ii, value in enumerate(values):
+    sels = list()
+    for value in values:
         # select trials e.g. according to visibility or contrast
-        sel = np.where(events[key] == value)[0]
+        sel = np.where(key_values == value)[0]
 
         # for clarity, add all absent trials in target_present analysis
         if analysis['name'] == 'target_present':
-            sel = np.r_[sel,
-                        np.where(events['target_present'] == False)[0]]  # noqa
+            sel = np.concatenate((sel, absent))
 
         # skip if not enough trials
         if len(sel) < 5 or len(np.unique(y_true[sel])) < 2:
-            continue
+            sel = None
+        sels.append(sel)
+    return sels
+
 
+def _subscore(y_pred, y_true, analysis, sels):
+    """Subscore each visibility
+    y_pred : shape(n_trials,) | shape(n_trials, n_times)
+    y_true : shape(n_trials,)
+    analysis : dict(name='target_present' | 'target_circAngle', scorer)
+    sels : list of trial indices per value, from _subscore_sels
+    """
+    if y_pred.ndim == 1:
+        y_pred = y_pred[:, np.newaxis]
+    n_samples, n_times = y_pred.shape
+
+    scores = np.nan * np.zeros((n_times, len(sels)))
+    for ii, sel in enumerate(sels):
+        if sel is None:
+            continue
         # score
-        scores[:, ii] = scorer(y_true=y_true[sel], y_pred=y_pred[sel])
+        scores[:, ii] = _score_times(y_true[sel], y_pred[sel], analysis)
     return scores
 
 
+def _score_times(y_true, y_pred, analysis):
+    """Score each time point (column) of the predictions at once
+    y_true : shape(n_trials,)
+    y_pred : shape(n_trials, n_times)
+    """
+    if analysis['typ'] == 'categorize':
+        # AUC from the Mann-Whitney U of the positive trials: ties get
+        # average ranks, as in roc_auc_score
+        y_true = y_true == np.max(y_true)
+        n_pos = np.sum(y_true)
+        n_neg = len(y_true) - n_pos
+        ranks = _rankdata(y_pred)
+        U = np.sum(ranks[y_true], axis=0) - n_pos * (n_pos + 1) / 2.
+        return U / (n_pos * n_neg)
+    elif analysis['typ'] == 'circ_regress':
+        # same as scorer_angle
+        error = (y_true[:, np.newaxis] - y_pred + np.pi) % (2 * np.pi) - np.pi
+        return np.pi / 2 - np.mean(np.abs(error), axis=0)
+    else:
+        scorer = analysis['scorer']
+        return np.array([scorer(y_true=y_true, y_pred=y_pred[:, [t]])
+                         for t in range(y_pred.shape[1])])
+
+
+def _rankdata(X, axis=0):
+    """Rank an array along an axis, ties getting their average rank, as
+    scipy's rankdata, with a single sort"""
+    X = np.swapaxes(X, axis, -1)
+    n_samples = X.shape[-1]
+    # index of each sample along the other axes
+    index = tuple(ii[..., np.newaxis]
+                  for ii in np.ix_(*[range(n) for n in X.shape[:-1]]))
+    order = np.argsort(X, axis=-1, kind='mergesort')
+    X_sorted = X[index + (order,)]
+    # first and last sorted position of the ties of each sorted sample
+    position = np.arange(n_samples)
+    new = np.ones(X.shape, bool)
+    new[..., 1:] = np.diff(X_sorted, axis=-1) != 0
+    first = np.maximum.accumulate(np.where(new, position, 0), axis=-1)
+    last = np.ones(X.shape, bool)
+    last[..., :-1] = new[..., 1:]
+    last = np.minimum.accumulate(
+        np.where(last, position, n_samples)[..., ::-1], axis=-1)[..., ::-1]
+    ranks = np.empty(X.shape)
+    ranks[index + (order,)] = (first + last) / 2. + 1
+    return np.swapaxes(ranks, axis, -1)
+
+
+def _subset_spearman(order, sel, y):
+    """Spearman correlation between each column of a matrix and a vector,
+    within a subset of rows.
+
+    order : array, shape (n_samples, n_columns)
+        Argsort of the matrix along its first axis, shared across subsets: the
+        ranks within a subset are the cumulative count of its rows along this
+        order.
+    sel : array, shape (n_selected,)
+        Rows of the subset.
+    y : array, shape (n_selected,)
+    """
+    n_samples, n_columns = order.shape
+    mask = np.zeros(n_samples, dtype=bool)
+    mask[sel] = True
+    ranks = np.zeros(order.shape)
+    ranks[order, np.arange(n_columns)] = np.cumsum(mask[order], axis=0)
+    X = ranks[sel] - (len(sel) + 1) / 2.
+    y = rankdata(y) - (len(sel) + 1) / 2.
+    return np.dot(y, X) / np.sqrt(np.sum(X ** 2, axis=0) * np.sum(y ** 2))
+
+
+def _rank_trend(X):
+    """Spearman correlation between each row of a matrix and its column
+    indices, i.e. repeated_spearman(range(n_columns), row) for all rows"""
+    n_columns = X.shape[1]
+    ranks = _rankdata(X, axis=1) - (n_columns + 1) / 2.
+    x = np.arange(n_columns) - (n_columns - 1) / 2.
+    return np.dot(ranks, x) / np.sqrt(np.sum(ranks ** 2, axis=1) *
+                                      np.sum(x ** 2))
+
+
 def _subregress(y_pred, events, analysis, factor, independent=False):
     """Correlate single trial error with factor"""
     factors = dict(visibility=['detect_button', range(4)],
@@ -137,41 +378,45 @@ def _subregress(y_pred, events, analysis, factor, independent=False):
         y_pred = y_pred[:, np.newaxis]
     n_times = y_pred.shape[1]
 
-    # Compute single trial error
+    # Compute single trial error, in place in a single buffer
+    y_error = np.empty(y_pred.shape)
+    np.subtract(y_pred, y_true[:, np.newaxis], out=y_error)
     if 'circAngle' in analysis['name']:
-        y_error = (y_pred - y_true[:, np.newaxis]) % (2 * np.pi)
-        y_error = np.abs(np.pi - y_error)
-    else:
-        y_error = np.abs(y_pred - y_true[:, np.newaxis])
+        np.mod(y_error, 2 * np.pi, out=y_error)
+        np.subtract(np.pi, y_error, out=y_error)
+    np.abs(y_error, out=y_error)
 
     # Do the prediction vary across visibilities/contrasts?
-    sel = np.intersect1d(
-        np.where(events['target_present'] == True)[0],  # noqa
-        np.where(events[key] >= values[0])[0])
+    key_values = np.array(events[key])
+    sel = np.array(events['target_present'], dtype=bool)
+    sel &= key_values >= values[0]
 
     if independent:
         # define covariate factor
         cov_factor = 'target_contrast' if factor == 'visibility' \
             else 'detect_button'
         cov_key, cov_values = factors[factor]
+        cov_factor_values = np.array(events[cov_factor])
 
+        # sort the errors once for all covariate values
+        order = np.argsort(y_error, axis=0)
         R = np.nan * np.zeros((len(cov_values), n_times))
         for ii, cov_value in enumerate(cov_values):
-            cov_sel = np.intersect1d(
-                np.where(events[cov_factor] == cov_value)[0], sel)
+            cov_sel = np.where(sel & (cov_factor_values == cov_value))[0]
             if len(cov_sel) <= 5:
                 continue
-            R[ii] = repeated_spearman(y_error[cov_sel], events[key][cov_sel])
-        R = np.nanmean(R, axis=0)
+            R[ii] = _subset_spearman(order, cov_sel, key_values[cov_sel])
+        R = nanmean(R, axis=0)
     else:
-        R = repeated_spearman(y_error[sel], events[key][sel])
+        sel = np.where(sel)[0]
+        R = repeated_spearman(y_error[sel], key_values[sel])
     return R
 
 
 def _analyze_continuous(analysis):
     """Regress prediction error as a function of visibility and contrast for
     each time point"""
-    ana_name = analysis['name'] + '-continuous'
+    ana_name = analysis['name'] + '-continuous-timewise'
 
     # don't recompute if not necessary
     fname = paths('score', analysis=ana_name)
@@ -179,26 +424,15 @@ def _analyze_continuous(analysis):
         return load('score', analysis=ana_name)
 
     # gather data
-    n_subject = 20
-    n_time = 151
-    scores = dict(visibility=np.zeros((n_subject, n_time, 4)),
-                  contrast=np.zeros((n_subject, n_time, 3)))
-    R = dict(visibility=np.zeros((n_subject, n_time)),
-             contrast=np.zeros((n_subject, n_time)),)
-    for s, subject in enumerate(subjects):
-        gat, _, events_sel, events = load('decod', subject=subject,
-                                          analysis=analysis['name'])
-        events = events.iloc[events_sel].reset_index()
-        y_pred = np.transpose(get_diagonal_ypred(gat), [1, 0, 2])[..., 0]
-        for factor in ['visibility', 'contrast']:
-            # subscore per condition (e.g. each visibility rating)
-            scores[factor][s, :, :] = _subscore(y_pred, events,
-                                                analysis, factor)
-            # correlate residuals with factor
-            R[factor][s, :] = _subregress(y_pred, events,
-                                          analysis, factor, True)
+    results = _gather(analysis)
+    subject_results = results.pop('-continuous-timewise')
+    times = results['times']
+    scores, R = dict(), dict()
+    for factor in ['visibility', 'contrast']:
+        scores[factor] = np.array([score[factor]
+                                   for score, _ in subject_results])
+        R[factor] = np.array([r[factor] for _, r in subject_results])
 
-    times = gat.train_times_['times']
     save([scores, R, times], 'score', analysis=ana_name,
          overwrite=True, upload=True)
     return [scores, R, times]
@@ -206,7 +440,7 @@ def _analyze_continuous(analysis):
 
 def _analyze_toi(analysis):
     """Subscore each analysis as a function of the reported visibility"""
-    ana_name = analysis['name'] + '-toi'
+    ana_name = analysis['name'] + '-toi-vecmean'
 
     # don't recompute if not necessary
     fname = paths('score', analysis=ana_name)
@@ -214,26 +448,12 @@ def _analyze_toi(analysis):
         return load('score', analysis=ana_name)
 
     # gather data
-    n_subject = 20
-    scores = dict(visibility=np.zeros((n_subject, len(tois), 4)),
-                  contrast=np.zeros((n_subject, len(tois), 3)))
-    R = dict(visibility=np.zeros((n_subject, len(tois))),
-             contrast=np.zeros((n_subject, len(tois))),)
-    for s, subject in enumerate(subjects):
-        gat, _, events_sel, events = load('decod', subject=subject,
-                                          analysis=analysis['name'])
-        events = events.iloc[events_sel].reset_index()
-        for t, toi in enumerate(tois):
-            # Average predictions on single trials across time points
-            y_pred = _average_ypred_toi(gat, toi, analysis)
-            # visibility
-            for factor in ['visibility', 'contrast']:
-                # subscore per condition (e.g. each visibility rating)
-                scores[factor][s, t, :] = _subscore(y_pred, events,
-                                                    analysis, factor)
-                # correlate residuals with factor
-                R[factor][s, t] = _subregress(y_pred, events,
-                                              analysis, factor, True)
+    subject_results = _gather(analysis).pop('-toi-vecmean')
+    scores, R = dict(), dict()
+    for factor in ['visibility', 'contrast']:
+        scores[factor] = np.array([score[factor]
+                                   for score, _ in subject_results])
+        R[factor] = np.array([r[factor] for _, r in subject_results])
 
     save([scores, R], 'score', analysis=ana_name, overwrite=True, upload=True)
     return [scores, R]
@@ -249,60 +469,53 @@ def _correlate(analysis):
         return load('score', analysis=ana_name)
 
     # gather data
-    all_R = list()
-    for subject in subjects:
-        gat, _, events_sel, events = load('decod', subject=subject,
-                                          analysis=analysis['name'])
-        times = gat.train_times_['times']
-        # remove irrelevant trials
-        events = events.iloc[events_sel].reset_index()
-        y_vis = np.array(events['detect_button'])
-
-        # only analyse present trials
-        sel = np.where(events['target_present'])[0]
-        y_vis = y_vis[sel]
-        gat.y_pred_ = gat.y_pred_[:, :, sel, :]
-
-        # make 2D y_pred
-        y_pred = gat.y_pred_.transpose(2, 0, 1, 3)[..., 0]
-        y_pred = y_pred.reshape(len(y_pred), -1)
-        # regress
-        R = repeated_spearman(y_pred, y_vis)
-        # reshape and store
-        R = R.reshape(*gat.y_pred_.shape[:2])
-        all_R.append(R)
-    all_R = np.array(all_R)
+    results = _gather(analysis)
+    all_R = np.array(results.pop('-Rvis'))
+    times = results['times']
 
     # stats
-    pval = stats(all_R)
+    pval = _cached_stats(all_R)
 
     save([all_R, pval, times], 'score', analysis=ana_name,
          overwrite=True, upload=True)
     return all_R, pval, times
 
 
-def _duration_toi(analysis):
+def _duration_toi(analysis, times):
     """Estimate temporal generalization
     Re-align on diagonal, average per toi and compute stats."""
     ana_name = analysis['name'] + '-duration-toi'
     if os.path.exists(paths('score', analysis=ana_name)):
         return load('score', analysis=ana_name)
-    all_scores, _, times = load('score', analysis=analysis['name'] + '-vis')
+    vis_name = analysis['name'] + '-vis'
+    if os.path.exists(paths('score_array', analysis=vis_name)):
+        # memory-mapped: only one GAT is read at a time
+        all_scores = load('score_array', analysis=vis_name)
+    else:
+        all_scores = load('score', analysis=vis_name)[0]
     # Add average duration
     n_subject = len(all_scores)
     all_score_tois = np.zeros((n_subject, 4, len(tois), len(times)))
     all_pval_tois = np.zeros((4, len(tois), len(times)))
+    # Align scores on training time and center the effect, as done by
+    # align_on_diag followed by a roll of half the times: the score at a given
+    # test time relative to train time is directly gathered from the GAT.
+    n_times = len(times)
+    toi_indices = list()
+    for toi in tois:
+        train = np.arange(n_times)[_toi_slice(times, toi)][:, np.newaxis]
+        test = (train + np.arange(n_times) + n_times // 2) % n_times
+        toi_indices.append((train, test))
+    for subject in range(n_subject):
+        for vis in range(4):
+            score = np.array(all_scores[subject, vis])
+            for t, (train, test) in enumerate(toi_indices):
+                all_score_tois[subject, vis, t, :] = np.mean(
+                    score[train, test], axis=0)
     for vis in range(4):
-        scores = all_scores[:, vis, ...]
-        # align score on training time
-        scores = [align_on_diag(score) for score in scores]
-        # center effect
-        scores = np.roll(scores, len(times) // 2, axis=2)
-        for t, toi in enumerate(tois):
-            toi = np.where((times >= toi[0]) & (times <= toi[1]))[0]
-            score_toi = np.mean(scores[:, toi, :], axis=1)
-            all_score_tois[:, vis, t, :] = score_toi
-            all_pval_tois[vis, t, :] = stats(score_toi - analysis['chance'])
+        for t in range(len(tois)):
+            all_pval_tois[vis, t, :] = _cached_stats(
+                all_score_tois[:, vis, t, :] - analysis['chance'])
     save([all_score_tois, all_pval_tois, times], 'score', analysis=ana_name)
     return [all_score_tois, all_pval_tois, times]
 
@@ -311,15 +524,18 @@ def _duration_toi(analysis):
 colors = dict(visibility=plt.get_cmap('bwr')(np.linspace(0, 1, 4.)),
               contrast=plt.get_cmap('hot_r')([.5, .75, 1.]))
 
+# Figures are only rendered in the report: avoid implicit draws
+plt.ioff()
+
 # Loop across visibility and orientation analyses
 for analysis in analyses:
     # Plot correlation of decoding score with visibility and contrast
     scores, R, times = _analyze_continuous(analysis)
     fig, (ax1, ax2) = plt.subplots(2, 1, figsize=[20, 10])
-    sig = stats(R['visibility']) < .05
+    sig = _cached_stats(R['visibility']) < .05
     pretty_decod(-R['visibility'], times=times, sig=sig, ax=ax1,
                  color='purple', fill=True)
-    sig = stats(R['contrast']) < .05
+    sig = _cached_stats(R['contrast']) < .05
     pretty_decod(-R['contrast'], times=times, sig=sig, ax=ax2,
                  color='orange', fill=True)
     report.add_figs_to_section([fig], ['continuous regress'], analysis['name'])
@@ -333,11 +549,10 @@ for analysis in analyses:
         fig, ax = plt.subplots(1, figsize=[14, 11])
         scores = all_scores[:, vis, ...]
         p_val = score_pvals[vis]
-        pretty_gat(np.nanmean(scores, axis=0), times=times,
+        pretty_gat(nanmean(scores, axis=0), times=times,
                    chance=analysis['chance'],
                    ax=ax, colorbar=False)
-        xx, yy = np.meshgrid(times, times, copy=False, indexing='xy')
-        ax.contour(xx, yy, p_val < .05, colors='black', levels=[0],
+        ax.contour(times, times, p_val < .05, colors='black', levels=[0],
                    linestyles='--', linewidth=5)
         ax.axvline(.800, color='k')
         ax.axhline(.800, color='k')
@@ -384,7 +599,7 @@ for analysis in analyses:
     report.add_figs_to_section([fig], [analysis['name']], 'slice_duration')
 
     # plot average slices toi to show duration
-    all_durations, toi_pvals, times = _duration_toi(analysis)
+    all_durations, toi_pvals, times = _duration_toi(analysis, times)
     roll_times = times-times[len(times)//2]
     if 'circAngle' in analysis['name']:
         all_durations /= 2.
@@ -395,12 +610,12 @@ for analysis in analyses:
             sig = toi_pvals[vis, t+1, :] < .05
             plot_sem(roll_times, score, color=colors['visibility'][vis],
                      alpha=.05, ax=ax)
-            pretty_decod(np.nanmean(score, 0), roll_times,
+            pretty_decod(nanmean(score, 0), roll_times,
                          color=colors['visibility'][vis],
                          chance=analysis['chance'], sig=sig, ax=ax)
         if ax != axes[-1]:
             ax.set_xlabel('')
-    mean_score = np.nanmean(all_durations[1:-1], axis=0)
+    mean_score = nanmean(all_durations[1:-1], axis=0)
     ticks = np.array([mean_score.min(), analysis['chance'], mean_score.max()])
     ticks = np.round(ticks * 100) / 100.
     ax.set_ylim(ticks[0], ticks[-1])
@@ -418,10 +633,9 @@ for analysis in analyses:
             continue
         pval = score_pvals[vis]
         sig = pval > .05
-        xx, yy = np.meshgrid(times, times, copy=False, indexing='xy')
-        ax.contourf(xx, yy, sig, levels=[-1, 0],
+        ax.contourf(times, times, sig, levels=[-1, 0],
                     colors=[colors['visibility'][vis]], aspect='equal')
-    ax.contour(xx, yy, R_pval > .05, levels=[-1, 0], colors='k',
+    ax.contour(times, times, R_pval > .05, levels=[-1, 0], colors='k',
                aspect='equal', linewidth=5, linestyle='--')
     ax.axvline(.800, color='k')
     ax.axhline(.800, color='k')
@@ -441,10 +655,9 @@ for analysis in analyses:
 
     # Plot GAT correlaltion between subscores and visibility
     fig, ax = plt.subplots(1, figsize=[10, 11])
-    pretty_gat(np.nanmean(all_R, axis=0), times=times,
+    pretty_gat(nanmean(all_R, axis=0), times=times,
                chance=0., ax=ax, colorbar=False)
-    xx, yy = np.meshgrid(times, times, copy=False, indexing='xy')
-    ax.contour(xx, yy, R_pval < .05, colors='black', levels=[0],
+    ax.contour(times, times, R_pval < .05, colors='black', levels=[0],
                linestyles='--', linewidth=5)
     ax.axvline(.800, color='k')
     ax.axhline(.800, color='k')
@@ -470,13 +683,14 @@ for analysis in analyses:
         toi_scores['visibility'] /= 2.
         toi_scores['visibility'] /= 2.
 
+    stats_text = '[%.3f+/-%.3f, p=%.4f]'
+
     def quick_stats(x, chance):
         # x = x[np.where(~np.isnan(x))[0]]
-        text = '[%.3f+/-%.3f, p=%.4f]'
-        m = np.nanmean(x)
-        sem = np.nanstd(x) / np.sqrt(len(x))
+        m = nanmean(x)
+        sem = nanstd(x) / np.sqrt(len(x))
         pval = wilcoxon(x - chance)[1]
-        return text % (m, sem, pval)
+        return stats_text % (m, sem, pval)
 
     # Orthogonolize visibility and contrast by subscoring visibility then
     # subscoring contrast
@@ -508,9 +722,8 @@ for analysis in analyses:
             table[toi, n_subscore + 1] = quick_stats(R[:, toi], chance=0.)
 
             # regression across scores: not single trials
-            adhoc_R = [repeated_spearman(range(n_subscore), subject)[0]
-                       for subject in score[:, toi, :]]
-            table[toi, n_subscore + 2] = quick_stats(np.array(adhoc_R), 0.)
+            adhoc_R = _rank_trend(score[:, toi, :])
+            table[toi, n_subscore + 2] = quick_stats(adhoc_R, 0.)
 
         pretty_axes(axes, xticks=[])
         report.add_figs_to_section([fig], [factor], analysis['name'])
@@ -525,10 +738,19 @@ for analysis in analyses:
 
         # Does the effect vary over time
         # e.g. seen-unseen stronger in early vs late
+        diffs = R[:, :, None] - R[:, None, :]
+        means = nanmean(diffs, axis=0)
+        sems = nanstd(diffs, axis=0) / np.sqrt(len(diffs))
+        # the signed-rank test is symmetric: only test the upper triangle
+        pvals = np.empty((len(tois), len(tois)))
+        for t1 in range(len(tois)):
+            for t2 in range(t1, len(tois)):
+                pvals[t1, t2] = pvals[t2, t1] = wilcoxon(diffs[:, t1, t2])[1]
         table = np.empty((len(tois), len(tois)), dtype=object)
         for t1 in range(len(tois)):
             for t2 in range(len(tois)):
-                table[t1, t2] = quick_stats(R[:, t1] - R[:, t2], 0.)
+                table[t1, t2] = stats_text % (means[t1, t2], sems[t1, t2],
+                                              pvals[t1, t2])
         report.add_htmls_to_section(table2html(table), 'toi_toi_' + factor,
                                     analysis['name'])
 
@@ -542,6 +764,9 @@ for analysis in analyses:
     report.add_htmls_to_section(table2html(table),
                                 'toi_subscore_', analysis['name'])
 
+    # figures are rendered in the report as soon as they are added to it
+    plt.close('all')
+
     # Stats for tested models
     all_scores, _, times = _subscore_pipeline(analysis)
     all_R, R_pval, _ = _correlate(analysis)
@@ -569,7 +794,7 @@ for analysis in analyses:
     scores = all_scores[:, vis, train_early, :]
 
     # --- cluster corrected
-    p_val = stats(scores - analysis['chance'])
+    p_val = _cached_stats(scores - analysis['chance'])
     sig_late = np.where(p_val[test_late] < .05)[0]
     if len(sig_late):
         table.append(dict(name='early gen cluster time',
@@ -586,7 +811,6 @@ for analysis in analyses:
     diag = diag[:, test_late].mean(1)
     table.append(dict(name='early gen average lower than diag',
                       disp=quick_stats(diag - mean_scores, 0.)))
-    report.add_htmls_to_section(table.to_html())
 
     # Test re-entry:
     # do early classifiers generalize differently across visibilities
@@ -602,7 +826,7 @@ for analysis in analyses:
     # Do late estimators generalize over the entire time period?
     train_500 = np.where(times >= .500)[0][0]
     scores = all_scores[:, vis, train_500, :]
-    p_val = stats(scores - analysis['chance'])
+    p_val = _cached_stats(scores - analysis['chance'])
     sig = np.where(p_val < .05)[0]
     if len(sig):
         first_cluster = np.array([sig[0],
@@ -612,4 +836,7 @@ for analysis in analyses:
         table.append(dict(name='t_500 generalize p_val',
                           disp=p_val[first_cluster[0]]))
 
+    table = np.array([[row['name'], str(row['disp'])] for row in table])
+    report.add_htmls_to_section(table2html(table), 'models', analysis['name'])
+
 report.save()